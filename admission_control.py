@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import logging, math, threading, time
+from collections import Counter
+from contextlib import contextmanager
+from itertools import count
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most important first
+PRINT = 'print'
+TEMPLATE_PRINT = 'template_print'
+PREVIEW = 'preview'
+PRIORITIES = {PRINT: 0, TEMPLATE_PRINT: 1, PREVIEW: 2}
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was not admitted. retry_after is the number of seconds
+    the client should wait before trying again.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+
+    def __init__(self, priority_class, client, seq):
+        self.priority_class = priority_class
+        self.priority = PRIORITIES[priority_class]
+        self.client = client
+        self.seq = seq
+        self.cancelled = None
+        self.started = None
+
+    def sort_key(self):
+        return self.priority, self.seq
+
+
+class AdmissionController:
+    """
+    Bounds the amount of rendering/printing work done at the same time.
+
+    At most max_active requests run concurrently, and at most `limit` of those
+    belong to the same priority class. Requests that cannot run right away
+    wait (at most max_wait seconds of their class) and are admitted in
+    priority order, oldest first. When more than max_queue requests are
+    waiting, the least important waiter is shed. A newer preview from a
+    client replaces that client's previews which are still waiting.
+    """
+
+    def __init__(self, max_active=4, max_queue=16, classes=None):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        # priority class -> {'LIMIT': concurrent requests, 'MAX_WAIT': seconds}
+        self.classes = {PRINT: {'LIMIT': 1, 'MAX_WAIT': 30},
+                        TEMPLATE_PRINT: {'LIMIT': 1, 'MAX_WAIT': 15},
+                        PREVIEW: {'LIMIT': 2, 'MAX_WAIT': 2}}
+        for name, settings in (classes or {}).items():
+            if name not in self.classes:
+                raise ValueError('Unknown admission class "{}", valid classes are: {}'.format(
+                    name, ', '.join(self.classes)))
+            self.classes[name].update(settings)
+
+        self._cond = threading.Condition()
+        self._active = Counter()
+        self._waiting = []
+        self._seq = count()
+        # exponentially weighted moving average of the service time per class
+        self._service_time = {name: 1.0 for name in self.classes}
+
+    @contextmanager
+    def admit(self, priority_class, client=None):
+        """ might raise AdmissionRejected() """
+        ticket = self.acquire(priority_class, client)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def acquire(self, priority_class, client=None):
+        """ might raise AdmissionRejected() """
+        deadline = time.monotonic() + self.classes[priority_class]['MAX_WAIT']
+        with self._cond:
+            ticket = _Ticket(priority_class, client, next(self._seq))
+
+            if priority_class == PREVIEW and client is not None:
+                for waiting in self._waiting:
+                    if waiting.priority_class == PREVIEW and waiting.client == client:
+                        waiting.cancelled = 'Superseded by a newer preview request'
+                self._cond.notify_all()
+
+            if not self._waiting and self._has_room(priority_class):
+                self._active[priority_class] += 1
+                ticket.started = time.monotonic()
+                return ticket
+
+            if len(self._live_waiters()) >= self.max_queue:
+                victim = max(self._live_waiters(), key=lambda t: (t.priority, -t.seq))
+                if victim.priority <= ticket.priority:
+                    raise AdmissionRejected('Too many queued requests', self._retry_after(priority_class))
+                victim.cancelled = 'Shed in favour of a more important request'
+
+            self._waiting.append(ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    if ticket.cancelled:
+                        logger.debug('Dropped %s request of %s: %s', priority_class, client, ticket.cancelled)
+                        raise AdmissionRejected(ticket.cancelled, self._retry_after(priority_class))
+                    if self._is_next(ticket):
+                        self._active[priority_class] += 1
+                        ticket.started = time.monotonic()
+                        return ticket
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionRejected('Timed out waiting for a free slot', self._retry_after(priority_class))
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def release(self, ticket):
+        duration = time.monotonic() - ticket.started
+        with self._cond:
+            self._active[ticket.priority_class] -= 1
+            average = self._service_time[ticket.priority_class]
+            self._service_time[ticket.priority_class] = 0.8 * average + 0.2 * duration
+            self._cond.notify_all()
+
+    def _has_room(self, priority_class):
+        return (sum(self._active.values()) < self.max_active and
+                self._active[priority_class] < self.classes[priority_class]['LIMIT'])
+
+    def _live_waiters(self):
+        return [t for t in self._waiting if not t.cancelled]
+
+    def _is_next(self, ticket):
+        if not self._has_room(ticket.priority_class):
+            return False
+        for waiting in self._live_waiters():
+            if waiting.sort_key() < ticket.sort_key() and self._has_room(waiting.priority_class):
+                return False
+        return True
+
+    def _retry_after(self, priority_class):
+        ahead = sum(1 for t in self._live_waiters() if t.priority <= PRIORITIES[priority_class])
+        seconds = self._service_time[priority_class] * (ahead + 1) / self.max_active
+        return max(1, math.ceil(seconds))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Compares the size of the raster data sent to the printer for typical labels
+with and without compression / blank line collapsing, and the conversion time
+of the brother_ql and the NumPy raster engine.
+With --verify, checks that both engines produce byte-identical raster data
+for all models and label sizes.
+"""
+
+import argparse, random, sys, time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from brother_ql import BrotherQLRaster, create_label
+from brother_ql.devicedependent import models, label_type_specs, label_sizes, two_color_support, ENDLESS_LABEL
+
+import raster_numpy
+from implementation_brother import CompactRaster
+
+ENGINES = (('brother_ql', create_label), ('numpy', raster_numpy.create_label))
+
+def grocy_label(width):
+    """ product label like create_label_grocy(): DataMatrix code, product name and due date """
+    im = Image.new('RGB', (width, 260), 'white')
+    draw = ImageDraw.Draw(im)
+    # a deterministic 22x22 module pattern stands in for the DataMatrix code
+    rng = random.Random(0)
+    for y in range(22):
+        for x in range(22):
+            if x == 0 or y == 21 or rng.random() < 0.5:
+                draw.rectangle((15 + x*5, 22 + y*5, 19 + x*5, 26 + y*5), fill='black')
+    draw.multiline_text((150, 12), 'Organic whole wheat\nspaghetti 500g', 'black', font=ImageFont.load_default(size=40))
+    draw.text((150, 130), '2024-02-29', 'black', font=ImageFont.load_default(size=32))
+    return im
+
+def text_label(width):
+    """ single line label like create_label_im() """
+    im = Image.new('RGB', (width, 120), 'white')
+    draw = ImageDraw.Draw(im)
+    draw.text((40, 24), 'Flour', 'black', font=ImageFont.load_default(size=70))
+    return im
+
+def red_label(width, height):
+    """ black/red label with a long endless layout """
+    im = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(im)
+    for y in range(0, height - 100, 160):
+        draw.rectangle((20, y + 20, 120, y + 120), fill=(230, 20, 20))
+        draw.text((150, y + 40), 'Batch {}'.format(y // 160), 'black', font=ImageFont.load_default(size=50))
+    return im
+
+def convert(model, label_size, im, compress, collapse, engine=create_label, red=False):
+    qlr = CompactRaster(model, collapse_blank_lines=collapse)
+    start = time.perf_counter()
+    engine(qlr, im, label_size, threshold=70, cut=True, rotate=0, compress=compress, red=red)
+    return qlr.data, time.perf_counter() - start
+
+def verify():
+    """ compare the output of both engines with brother_ql's own BrotherQLRaster, returns the number of mismatches """
+    rng = random.Random(0)
+    mismatches = cases = 0
+    for model in models:
+        for label_size in label_sizes:
+            specs = label_type_specs[label_size]
+            width, height = specs['dots_printable']
+            if width > BrotherQLRaster(model).get_pixel_width():
+                continue
+            if specs['kind'] == ENDLESS_LABEL:
+                height = 300
+            red = 'red' in label_size
+            if red and model not in two_color_support:
+                continue
+            im = Image.new('RGB', (width, height), 'white')
+            draw = ImageDraw.Draw(im)
+            for _ in range(40):
+                x, y = rng.randrange(width), rng.randrange(height)
+                color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                draw.rectangle((x, y, x + rng.randrange(80), y + rng.randrange(50)), fill=color)
+            for compress in (False, True):
+                for dither in ((False,) if red else (False, True)):
+                    kwargs = dict(threshold=70, cut=True, rotate=0, compress=compress, red=red, dither=dither)
+                    golden = BrotherQLRaster(model)
+                    create_label(golden, im, label_size, **kwargs)
+                    for name, engine in ENGINES:
+                        qlr = CompactRaster(model, collapse_blank_lines=False)
+                        engine(qlr, im, label_size, **kwargs)
+                        cases += 1
+                        if qlr.data != golden.data:
+                            mismatches += 1
+                            print('MISMATCH {} {} {} {}'.format(name, model, label_size, kwargs))
+    print('{} conversions compared, {} mismatches'.format(cases, mismatches))
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='QL-820NWB', choices=models)
+    parser.add_argument('--label-size', default='62')
+    parser.add_argument('--verify', action='store_true', help='compare the raster engines across all models and label sizes')
+    args = parser.parse_args()
+
+    if args.verify:
+        sys.exit(1 if verify() else 0)
+
+    width = label_type_specs[args.label_size]['dots_printable'][0]
+    variants = (('uncompressed', False, False), ('compressed', True, False), ('compressed + blank lines', True, True))
+    for name, im in (('grocy', grocy_label(width)), ('text', text_label(width))):
+        baseline = None
+        for variant, compress, collapse in variants:
+            data, seconds = convert(args.model, args.label_size, im, compress, collapse)
+            baseline = baseline or len(data)
+            print('{:6} {:26} {:7d} bytes ({:5.1f}%)  {:6.1f} ms'.format(
+                name, variant, len(data), 100 * len(data) / baseline, seconds * 1000))
+
+    red = args.model in two_color_support
+    label_size = '62red' if red else args.label_size
+    im = red_label(width, 3000) if red else grocy_label(width)
+    for name, engine in ENGINES:
+        data, seconds = convert(args.model, label_size, im, True, True, engine=engine, red=red)
+        print('{:10} engine, {} {}x{} label: {:7.1f} ms'.format(name, label_size, im.size[0], im.size[1], seconds * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,9 @@ import cups
 
 import textwrap
 
-import sys, logging, random, json, argparse
+import sys, os, logging, random, json, argparse, functools, hmac, threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
 from io import BytesIO
 
 from bottle import run, route, get, post, response, request, jinja2_view as view, static_file, redirect
@@ -25,6 +27,10 @@ from brother_ql.backends import backend_factory, guess_backend
 from implementation_cups import implementation
 
 from font_helpers import get_fonts
+from profile_helpers import profile_call, stats_to_text, store_stats, SamplingProfiler
+from image_cache import BitmapCache
+from render_cache import create_cache, cache_key
+from admission_control import AdmissionController, AdmissionRejected, PRINT, TEMPLATE_PRINT, PREVIEW
 
 logger = logging.getLogger(__name__)
 instance = implementation()
@@ -38,6 +44,117 @@ except FileNotFoundError as e:
     with open('config.example.json', encoding='utf-8') as fh:
         CONFIG = json.load(fh)
 
+SAMPLER = SamplingProfiler(('adjust_font_to_fit', 'element_text', 'print_label'))
+
+def profiling_authorized(request):
+    """
+    Profiling is only available when a PROFILING.TOKEN is configured and
+    the request carries it (X-Profile-Token header or profile_token parameter).
+    """
+    expected = CONFIG.get('PROFILING', {}).get('TOKEN')
+    if not expected:
+        return False
+    provided = request.get_header('X-Profile-Token') or request.params.get('profile_token', '')
+    return hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
+
+def profiling_requested():
+    """
+    Whether the request asks to be profiled (?profile=1 or ?profile=store, 0 means off).
+    Such requests bypass the render cache, otherwise they would only profile the cache lookup.
+    """
+    return request.query.get('profile') not in (None, '', '0')
+
+def profiling_denied():
+    """ Response for requests that aren't allowed to profile """
+    response.status = 403
+    return {'success': False, 'error': 'Profiling is disabled or the profile token is invalid'}
+
+def profiled(func):
+    """
+    Run the wrapped route under cProfile when called with ?profile=1
+    (the call-graph statistics are returned instead of the normal response)
+    or ?profile=store (the normal response is returned and the statistics are
+    stored for download, see the X-Profile header).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiling_requested():
+            return func(*args, **kwargs)
+        if not profiling_authorized(request):
+            return profiling_denied()
+
+        result, stats = profile_call(func, *args, **kwargs)
+        if request.query.get('profile') == 'store':
+            folder = CONFIG['PROFILING'].get('OUTPUT_FOLDER', 'profiles')
+            filename = store_stats(stats, folder, func.__name__)
+            response.set_header('X-Profile', '/api/profile/' + filename)
+            return result
+        response.set_header('Content-type', 'text/plain')
+        return stats_to_text(stats)
+    return wrapper
+
+ADMISSION = AdmissionController(max_active=CONFIG.get('ADMISSION', {}).get('MAX_ACTIVE', 4),
+                                max_queue=CONFIG.get('ADMISSION', {}).get('MAX_QUEUE', 16),
+                                classes=CONFIG.get('ADMISSION', {}).get('CLASSES'))
+
+BITMAP_CACHE = BitmapCache(folder=CONFIG.get('IMAGE_CACHE', {}).get('FOLDER') or None,
+                           max_entries=CONFIG.get('IMAGE_CACHE', {}).get('MAX_ENTRIES', 64))
+
+RENDER_CACHE = create_cache(CONFIG.get('CACHE', {}))
+
+# Requests are handled in parallel threads, but the printer can only take one job at a time:
+# the CUPS implementation prints via a shared file and the Brother backends open the device.
+PRINT_LOCK = threading.Lock()
+
+def print_label(key_parts, render, **context):
+    """
+    Print the label rendered by render(). The print-ready data is cached under the
+    render inputs (key_parts) and the printer settings, so on a cache hit neither
+    rendering nor conversion is done.
+    """
+    key = cache_key('print', implementation.__module__, CONFIG['PRINTER'], *key_parts)
+    data = None if profiling_requested() else RENDER_CACHE.get(key)
+    if data is None:
+        im = render()
+        if DEBUG:
+            im.save('sample-out.png')
+        data = instance.get_print_data(im, **context)
+        RENDER_CACHE.set(key, data)
+    with PRINT_LOCK:
+        return instance.print_data(data, **context)
+
+def client_identity(request):
+    """
+    Designer tabs send a client_id so that they don't replace each other's previews.
+    Clients that don't identify themselves (None) never replace each other's previews,
+    behind a load balancer they would all share the same remote address.
+    """
+    return request.get_header('X-Client-Id') or request.params.get('client_id') or None
+
+def admitted(priority_class):
+    """
+    Only run the wrapped route once the admission controller grants it a slot,
+    otherwise answer with 429 and a Retry-After header.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket = ADMISSION.acquire(priority_class, client_identity(request))
+            except AdmissionRejected as e:
+                response.status = 429
+                response.set_header('Retry-After', str(e.retry_after))
+                return {'success': False, 'message': str(e)}
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ADMISSION.release(ticket)
+        return wrapper
+    return decorator
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
 
 @route('/')
 def index():
@@ -56,9 +173,51 @@ def labeldesigner():
             'label_sizes': LABEL_SIZES,
             'website': CONFIG['WEBSITE'],
             'label': CONFIG['LABEL']}
-    
+
+@get('/api/profile/sampling')
+@post('/api/profile/sampling')
+def profile_sampling():
+    """
+    Inspect or toggle the sampling profiler.
+
+    Parameters: enabled=1|0 to start/stop sampling, reset=1 to clear the
+    collected samples, limit=N for the number of hot stacks to return.
+
+    returns: JSON
+    """
+    if not profiling_authorized(request):
+        return profiling_denied()
+
+    enabled = request.params.get('enabled')
+    if enabled in ('1', 'true'):
+        SAMPLER.start()
+    elif enabled in ('0', 'false'):
+        SAMPLER.stop()
+    if request.params.get('reset') in ('1', 'true'):
+        SAMPLER.reset()
+
+    try:
+        limit = int(request.params.get('limit', 20))
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        response.status = 400
+        return {'success': False, 'error': 'limit has to be a non-negative number'}
+
+    return_dict = SAMPLER.hot_stacks(limit)
+    return_dict['success'] = True
+    return return_dict
+
+@get('/api/profile/<filename>')
+def profile_download(filename):
+    if not profiling_authorized(request):
+        return profiling_denied()
+    return static_file(filename, root=CONFIG['PROFILING'].get('OUTPUT_FOLDER', 'profiles'), download=True)
+
 @get('/api/print/template/<templatefile>')
 @post('/api/print/template/<templatefile>')
+@admitted(TEMPLATE_PRINT)
+@profiled
 def printtemplate(templatefile):
     return_dict = {'Success': False}
     template_data = get_template_data(templatefile)
@@ -69,11 +228,12 @@ def printtemplate(templatefile):
         return_dict['error'] = e.message
         return return_dict
         
-    im = create_label_from_template(template_data, **context)
-    if DEBUG:
-        im.save('sample-out.png')
-    
-    return instance.print_label(im, **context)
+    try:
+        return print_label(('template', template_data, template_image_mtimes(template_data), context),
+                           lambda: create_label_from_template(template_data, **context), **context)
+    except TemplateError as e:
+        return_dict['error'] = str(e)
+        return return_dict
     
 def get_template_data(templatefile):
     template_data = None
@@ -81,6 +241,9 @@ def get_template_data(templatefile):
         template_data = json.load(file)
     return template_data
 
+class TemplateError(Exception):
+    """ The template can't be rendered, e.g. because the file of an image element is missing """
+
 def create_label_from_template(template, **kwargs):
     width, height = instance.get_label_width_height(get_value(template, kwargs, 'font_path'), **kwargs)
     width = template.get('width', width)
@@ -103,6 +266,8 @@ def create_label_from_template(template, **kwargs):
             im = element_datamatrix(element, im, margins, dimensions, **kwargs)
         elif element_type == 'text':
             im = element_text(element, im, margins, dimensions, **kwargs)
+        elif element_type == 'image':
+            im = element_image(element, im, margins, dimensions, **kwargs)
     
     return im
     
@@ -125,6 +290,31 @@ def element_datamatrix(element, im, margins, dimensions, **kwargs):
 
     return im
     
+def element_image(element, im, margins, dimensions, **kwargs):
+    horizontal_offset = element['horizontal_offset']
+    vertical_offset = element['vertical_offset']
+
+    width = element.get('width', dimensions[0] - horizontal_offset - margins[2])
+    height = element.get('height', dimensions[1] - vertical_offset - margins[3])
+    red = 'red' in kwargs.get('label_size', '')
+
+    try:
+        layers = BITMAP_CACHE.get(element['path'], (width, height), red=red,
+                                  threshold=get_value(element, kwargs, 'threshold', 70),
+                                  dither=element.get('dither', False))
+    except (OSError, KeyError) as e:
+        raise image_element_error(element, e)
+    for color, mask in layers:
+        im.paste(color, (horizontal_offset, vertical_offset), mask)
+
+    return im
+    
+def image_element_error(element, e):
+    """ TemplateError for an image element without a path or whose file can't be loaded """
+    if 'path' not in element:
+        return TemplateError('Image element without a path')
+    return TemplateError("Couldn't load image {}: {}".format(element['path'], getattr(e, 'strerror', None) or e))
+
 def element_text(element, im, margins, dimensions, **kwargs):
     data = element.get('data', kwargs.get(element.get('key')))
     
@@ -347,49 +537,80 @@ def create_label_grocy(text, **kwargs):
 
 @get('/api/preview/text')
 @post('/api/preview/text')
+@admitted(PREVIEW)
+@profiled
 def get_preview_image():
     context = get_label_context(request)
-    im = create_label_im(**context)
+    png = render_preview(('text', context), lambda: create_label_im(**context))
     return_format = request.query.get('return_format', 'png')
     if return_format == 'base64':
         import base64
         response.set_header('Content-type', 'text/plain')
-        return base64.b64encode(image_to_png_bytes(im))
+        return base64.b64encode(png)
     else:
         response.set_header('Content-type', 'image/png')
-        return image_to_png_bytes(im)
+        return png
 
 
 @get('/api/preview/grocy')
 @post('/api/preview/grocy')
+@admitted(PREVIEW)
+@profiled
 def get_preview_grocy_image():
     context = get_label_context(request)
-    im = create_label_grocy(**context)
+    png = render_preview(('grocy', context), lambda: create_label_grocy(**context))
     return_format = request.query.get('return_format', 'png')
     if return_format == 'base64':
         import base64
         response.set_header('Content-type', 'text/plain')
-        return base64.b64encode(image_to_png_bytes(im))
+        return base64.b64encode(png)
     else:
         response.set_header('Content-type', 'image/png')
-        return image_to_png_bytes(im)
+        return png
         
 @get('/api/preview/template/<templatefile>')
 @post('/api/preview/template/<templatefile>')
+@admitted(PREVIEW)
+@profiled
 def get_preview_template_image(templatefile):
     context = get_label_context(request)
     template_data = get_template_data(templatefile)
 
-    im = create_label_from_template(template_data, **context)
+    try:
+        png = render_preview(('template', template_data, template_image_mtimes(template_data), context),
+                             lambda: create_label_from_template(template_data, **context))
+    except TemplateError as e:
+        response.status = 400
+        return {'success': False, 'error': str(e)}
     return_format = request.query.get('return_format', 'png')
     if return_format == 'base64':
         import base64
         response.set_header('Content-type', 'text/plain')
-        return base64.b64encode(image_to_png_bytes(im))
+        return base64.b64encode(png)
     else:
         response.set_header('Content-type', 'image/png')
-        return image_to_png_bytes(im)
-
+        return png
+
+
+def render_preview(key_parts, render):
+    """ PNG bytes of render(), taken from the render cache if the same preview was rendered before """
+    key = cache_key('preview', *key_parts)
+    png = None if profiling_requested() else RENDER_CACHE.get(key)
+    if png is None:
+        png = image_to_png_bytes(render())
+        RENDER_CACHE.set(key, png)
+    return png
+
+def template_image_mtimes(template):
+    """ image elements are part of the rendering, so changing their files has to invalidate the cache """
+    mtimes = []
+    for element in template.get('elements', []):
+        if element['type'] == 'image':
+            try:
+                mtimes.append((element['path'], os.stat(element['path']).st_mtime_ns))
+            except (OSError, KeyError) as e:
+                raise image_element_error(element, e)
+    return mtimes
 
 def image_to_png_bytes(im):
     image_buffer = BytesIO()
@@ -399,6 +620,8 @@ def image_to_png_bytes(im):
 
 @post('/api/print/grocy')
 @get('/api/print/grocy')
+@admitted(PRINT)
+@profiled
 def print_grocy():
     """
     API endpoint to consume the grocy label webhook.
@@ -417,14 +640,12 @@ def print_grocy():
         return_dict['error'] = 'Please provide the product for the label'
         return return_dict
 
-    im = create_label_grocy(**context)
-    if DEBUG:
-        im.save('sample-out.png')
-        
-    return instance.print_label(im, **context)
+    return print_label(('grocy', context), lambda: create_label_grocy(**context), **context)
 
 @post('/api/print/text')
 @get('/api/print/text')
+@admitted(PRINT)
+@profiled
 def print_text():
     """
     API to print a label
@@ -447,10 +668,7 @@ def print_text():
         return_dict['error'] = 'Please provide the text for the label'
         return return_dict
 
-    im = create_label_im(**context)
-    if DEBUG: im.save('sample-out.png')
-
-    return instance.print_label(im, **context)
+    return print_label(('text', context), lambda: create_label_im(**context), **context)
 
 def main():
     global DEBUG, FONTS, BACKEND_CLASS, CONFIG
@@ -532,7 +750,14 @@ def main():
         CONFIG['LABEL']['DEFAULT_FONTS'] = {'family': family, 'style': style}
         sys.stderr.write('The default font is now set to: {family} ({style})\n'.format(**CONFIG['LABEL']['DEFAULT_FONTS']))
 
-    run(host=CONFIG['SERVER']['HOST'], port=PORT, debug=DEBUG)
+    SAMPLER.interval = CONFIG.get('PROFILING', {}).get('SAMPLE_INTERVAL', SAMPLER.interval)
+    if CONFIG.get('PROFILING', {}).get('SAMPLING', False):
+        SAMPLER.start()
+
+    if CONFIG['SERVER'].get('THREADED', True):
+        run(host=CONFIG['SERVER']['HOST'], port=PORT, debug=DEBUG, server_class=ThreadingWSGIServer)
+    else:
+        run(host=CONFIG['SERVER']['HOST'], port=PORT, debug=DEBUG)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import hashlib, logging, mmap, os, struct, tempfile, threading
+from collections import OrderedDict
+
+from PIL import Image, ImageChops, ImageOps
+
+logger = logging.getLogger(__name__)
+
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+
+# source mtime (ns), width, height, number of layers, red layer present
+_HEADER = struct.Struct('<qHHBB')
+
+
+def prepare_bitmap(path, size, red=False, threshold=70, dither=False):
+    """
+    Decode the image at path, scale it to fit into size (width, height),
+    flatten transparency onto white and reduce it to what the printer can print.
+
+    Returns a list of (color, mask) layers, the masks being 1-bit images.
+    With red=True, the red parts end up in a separate red layer.
+    """
+    with Image.open(path) as source:
+        if source.mode in ('RGBA', 'LA') or (source.mode == 'P' and 'transparency' in source.info):
+            rgba = source.convert('RGBA')
+            im = Image.new('RGB', rgba.size, 'white')
+            im.paste(rgba, mask=rgba.split()[-1])
+        else:
+            im = source.convert('RGB')
+    im = ImageOps.contain(im, size, Image.LANCZOS)
+
+    # same semantics as brother_ql: the higher the threshold, the more gets printed
+    cutoff = min(255, max(0, int((100 - threshold) / 100 * 255)))
+    inverted = ImageOps.invert(im.convert('L'))
+    if dither:
+        black = inverted.convert('1', dither=Image.FLOYDSTEINBERG)
+    else:
+        black = inverted.point(lambda x: 255 if x >= cutoff else 0, mode='1')
+
+    if not red:
+        return [(BLACK, black)]
+
+    hue, saturation, value = im.convert('HSV').split()
+    red_mask = ImageChops.logical_and(
+        ImageChops.logical_and(hue.point(lambda h: 255 if (h < 40 or h > 210) else 0, mode='1'),
+                               saturation.point(lambda s: 255 if s > 100 else 0, mode='1')),
+        value.point(lambda v: 255 if v > 80 else 0, mode='1'))
+    black = ImageChops.subtract(black, red_mask)
+    return [(BLACK, black), (RED, red_mask)]
+
+
+class BitmapCache:
+    """
+    Keeps the preprocessed bitmaps of image elements, so that every label after the
+    first one only has to paste them. Entries live in memory (LRU, max_entries) and,
+    if a folder is given, as raw 1-bit bitmaps on disk which are memory-mapped when
+    read. Both are invalidated when the modification time of the source changes.
+    """
+
+    def __init__(self, folder=None, max_entries=64):
+        self.folder = folder
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def get(self, path, size, red=False, threshold=70, dither=False):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, tuple(size), red, threshold, dither)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        layers = None
+        if self.folder:
+            layers = self._read(key, mtime)
+        if layers is None:
+            logger.debug('Preparing bitmap for %s at %s', path, size)
+            layers = prepare_bitmap(path, size, red=red, threshold=threshold, dither=dither)
+            if self.folder:
+                self._write(key, mtime, layers)
+
+        with self._lock:
+            self._entries[key] = (mtime, layers)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return layers
+
+    def _filename(self, key):
+        return os.path.join(self.folder, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.bitmap')
+
+    def _read(self, key, mtime):
+        try:
+            with open(self._filename(key), 'rb') as fh, \
+                 mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                source_mtime, width, height, count, has_red = _HEADER.unpack_from(mm)
+                if source_mtime != mtime:
+                    return None
+                length = (width + 7) // 8 * height
+                colors = (BLACK, RED) if has_red else (BLACK,)
+                layers = []
+                with memoryview(mm) as view:
+                    for i in range(count):
+                        offset = _HEADER.size + i * length
+                        mask = Image.frombytes('1', (width, height), view[offset:offset + length])
+                        layers.append((colors[i], mask))
+                return layers
+        except (OSError, ValueError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning('Ignoring unreadable bitmap cache entry for %s: %s', key[0], e)
+            return None
+
+    def _write(self, key, mtime, layers):
+        width, height = layers[0][1].size
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(_HEADER.pack(mtime, width, height, len(layers), len(layers) > 1))
+                for color, mask in layers:
+                    fh.write(mask.tobytes())
+            os.replace(tmp, self._filename(key))
+        except OSError as e:
+            logger.warning('Could not write bitmap cache entry for %s: %s', key[0], e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
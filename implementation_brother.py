@@ -1,8 +1,73 @@
-from brother_ql.devicedependent import models, label_type_specs, label_sizes
+import time
+from io import BytesIO
+
+import packbits
+from PIL import Image
+
+from brother_ql.devicedependent import models, label_type_specs, label_sizes, compressionsupport
 from brother_ql.devicedependent import ENDLESS_LABEL, DIE_CUT_LABEL, ROUND_DIE_CUT_LABEL
-from brother_ql import BrotherQLRaster, create_label
+from brother_ql import BrotherQLRaster, BrotherQLRasterError, create_label
 from brother_ql.backends import backend_factory, guess_backend
 
+try:
+    import raster_numpy
+except ImportError:
+    raster_numpy = None
+
+class CompactRaster(BrotherQLRaster):
+    """
+    BrotherQLRaster which sends blank raster lines as a single 'Z' (zero raster graphics)
+    command instead of a packbits-compressed 'g' line. The printer only accepts 'Z'
+    in compression mode and for single-colour jobs, so blank lines are sent in full
+    without compression and for two-colour jobs.
+    """
+
+    def __init__(self, model='QL-500', collapse_blank_lines=True):
+        super().__init__(model)
+        self.collapse_blank_lines = collapse_blank_lines
+
+    def add_raster_data(self, image, second_image=None):
+        """ image: Pillow Image() """
+        if image.size[0] != self.get_pixel_width():
+            fmt = 'Wrong pixel width: {}, expected {}'
+            raise BrotherQLRasterError(fmt.format(image.size[0], self.get_pixel_width()))
+        if second_image and image.size != second_image.size:
+            fmt = "First and second image don't have the same dimesions: {} vs {}."
+            raise BrotherQLRasterError(fmt.format(image.size, second_image.size))
+        row_len = image.size[0]//8
+        frames = []
+        for im in (image, second_image) if second_image else (image,):
+            frame = im.transpose(Image.FLIP_LEFT_RIGHT).convert("1").tobytes(encoder_name='raw')
+            frames.append([frame[start:start+row_len] for start in range(0, len(frame) - row_len + 1, row_len)])
+        self.add_raster_rows(*frames)
+
+    def add_raster_rows(self, rows, second_rows=None):
+        """
+        rows: the packed, already mirrored raster lines of the (black) image,
+        second_rows: those of the red image when printing in two colours
+        """
+        file_str = BytesIO()
+        collapse = self.collapse_blank_lines and self._compression and second_rows is None
+        # labels repeat lines a lot, each distinct line only has to be compressed once
+        encoded = {}
+        blank = bytes(self.get_pixel_width()//8)
+        for lines in zip(rows, second_rows) if second_rows is not None else zip(rows):
+            for i, row in enumerate(lines):
+                if collapse and row == blank:
+                    file_str.write(b'\x5A')
+                    continue
+                if second_rows is not None:
+                    file_str.write(b'\x77\x01' if i == 0 else b'\x77\x02')
+                else:
+                    file_str.write(b'\x67\x00')
+                if self._compression:
+                    if row not in encoded:
+                        encoded[row] = packbits.encode(row)
+                    row = encoded[row]
+                file_str.write(bytes([len(row)]))
+                file_str.write(row)
+        self.data += file_str.getvalue()
+
 class implementation:
 
     def __init__(self):
@@ -21,6 +86,16 @@ class implementation:
         except ValueError:
             error = "Couln't guess the backend to use from the printer string descriptor"
         self.BACKEND_CLASS = backend_factory(selected_backend)['backend_class']        
+
+        compression = self.CONFIG['PRINTER'].get('COMPRESSION', 'auto')
+        if compression != 'auto' and not isinstance(compression, bool):
+            error = 'Invalid PRINTER.COMPRESSION {!r}, it has to be "auto", true or false'.format(compression)
+        elif compression is True and self.CONFIG['PRINTER']['MODEL'] not in compressionsupport:
+            error = 'PRINTER.COMPRESSION is true, but the {} does not support compression'.format(self.CONFIG['PRINTER']['MODEL'])
+
+        engine = self.CONFIG['PRINTER'].get('RASTER_ENGINE', 'numpy')
+        if engine not in ('numpy', 'brother_ql'):
+            error = 'Invalid PRINTER.RASTER_ENGINE {!r}, it has to be "numpy" or "brother_ql"'.format(engine)
         
         return error
     
@@ -70,33 +145,60 @@ class implementation:
         offset = horizontal_offset, vertical_offset        
         return offset
         
-    def print_label(self, im, **context):
-        return_dict = {'success' : False }
-        
+    def use_compression(self, model):
+        """ PRINTER.COMPRESSION: "auto" (default, if the model supports it), true or false """
+        setting = self.CONFIG['PRINTER'].get('COMPRESSION', 'auto')
+        if setting == 'auto':
+            return model in compressionsupport
+        return setting
+
+    def get_create_label(self):
+        """ PRINTER.RASTER_ENGINE: "numpy" (default, if NumPy is installed) or "brother_ql" """
+        engine = self.CONFIG['PRINTER'].get('RASTER_ENGINE', 'numpy')
+        if engine == 'numpy' and raster_numpy is not None:
+            return raster_numpy.create_label
+        return create_label
+
+    def get_print_data(self, im, **context):
+        """ The raster data that prints the rendered label im """
         if context['kind'] == ENDLESS_LABEL:
             rotate = 0 if context['orientation'] == 'standard' else 90
         elif context['kind'] in (ROUND_DIE_CUT_LABEL, DIE_CUT_LABEL):
             rotate = 'auto'
 
-        qlr = BrotherQLRaster(self.CONFIG['PRINTER']['MODEL'])
+        model = self.CONFIG['PRINTER']['MODEL']
         red = False
         if 'red' in context['label_size']:
             red = True
 
-        create_label(qlr, im, context['label_size'], red=red, threshold=context['threshold'], cut=True, rotate=rotate)
+        qlr = CompactRaster(model, collapse_blank_lines=self.CONFIG['PRINTER'].get('COLLAPSE_BLANK_LINES', True))
+        self.get_create_label()(qlr, im, context['label_size'], red=red, threshold=context['threshold'], cut=True, rotate=rotate, compress=self.use_compression(model))
+        # the print data may be cached and sent later, so what was actually produced is logged here
+        self.logger.info('Converted label to %d bytes of raster data (compression %s)',
+                         len(qlr.data), 'on' if qlr._compression else 'off')
+        return qlr.data
+
+    def print_data(self, data, **context):
+        return_dict = {'success' : False }
 
         if not self.DEBUG:
             try:
+                start = time.perf_counter()
                 be = self.BACKEND_CLASS(self.CONFIG['PRINTER']['PRINTER'])
-                be.write(qlr.data)
+                be.write(data)
                 be.dispose()
                 del be
+                self.logger.info('Sent %d bytes to %s in %.1f ms',
+                                 len(data), self.CONFIG['PRINTER']['PRINTER'], (time.perf_counter() - start) * 1000)
             except Exception as e:
                 return_dict['message'] = str(e)
                 self.logger.warning('Exception happened: %s', e)
                 return return_dict
         
         return_dict['success'] = True
-        if self.DEBUG: return_dict['data'] = str(qlr.data)
+        if self.DEBUG: return_dict['data'] = str(data)
         
-        return return_dict
\ No newline at end of file
+        return return_dict
+
+    def print_label(self, im, **context):
+        return self.print_data(self.get_print_data(im, **context), **context)
\ No newline at end of file
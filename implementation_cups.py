@@ -1,4 +1,5 @@
 import cups
+from io import BytesIO
 
 # Printer-specific settings
 # Set these based on your printer and loaded labels
@@ -83,14 +84,24 @@ class implementation:
         offset = horizontal_offset, vertical_offset        
         return offset
             
-    def print_label(self, im, **context):
+    def get_print_data(self, im, **context):
+        """ The PNG file that prints the rendered label im """
+        image_buffer = BytesIO()
+        im.save(image_buffer, format="PNG")
+        return image_buffer.getvalue()
+
+    def print_data(self, data, **context):
         return_dict = {'success' : False }
 
-        im.save('sample-out.png')
+        with open('sample-out.png', 'wb') as fh:
+            fh.write(data)
         
         conn = cups.Connection()
         conn.printFile(printer_name, 'sample-out.png', "grocy", {})
         
         return_dict['success'] = True
         
-        return return_dict
\ No newline at end of file
+        return return_dict
+
+    def print_label(self, im, **context):
+        return self.print_data(self.get_print_data(im, **context), **context)
\ No newline at end of file
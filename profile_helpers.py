@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import cProfile, io, logging, os, pstats, sys, threading
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# cProfile cannot run two profilers at once (Python 3.12+ refuses outright),
+# so on-demand profiles are taken one request at a time.
+_profile_lock = threading.Lock()
+
+def profile_call(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) under cProfile and
+    return a tuple of (result, pstats.Stats)
+    """
+    with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return result, pstats.Stats(profiler)
+
+def stats_to_text(stats, sort_by='cumulative', limit=50):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort_by).print_stats(limit)
+    stats.print_callers(limit)
+    return stream.getvalue()
+
+def store_stats(stats, folder, name):
+    """
+    Dump the stats in the binary format understood by pstats / snakeviz
+    and return the file name (relative to folder)
+    """
+    os.makedirs(folder, exist_ok=True)
+    filename = '{}-{}.prof'.format(datetime.now().strftime('%Y%m%d-%H%M%S-%f'), name)
+    stats.dump_stats(os.path.join(folder, filename))
+    return filename
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler.
+
+    A daemon thread wakes up every `interval` seconds, inspects the stacks of
+    all other threads and counts those that are currently inside one of the
+    watched functions. Nothing is hooked into the interpreter, so when the
+    sampler is stopped it costs nothing.
+    """
+
+    def __init__(self, function_names, interval=0.01, max_depth=30):
+        self.function_names = set(function_names)
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.sample_count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info('Sampling profiler started (interval %.3fs)', self.interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info('Sampling profiler stopped')
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.sample_count = 0
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = self._watched_stack(frame)
+                if stack is not None:
+                    with self._lock:
+                        self.samples[stack] += 1
+                        self.sample_count += 1
+
+    def _watched_stack(self, frame):
+        stack = []
+        watched = False
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append('{}:{}({})'.format(os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+            if code.co_name in self.function_names:
+                watched = True
+            frame = frame.f_back
+        if not watched:
+            return None
+        return tuple(reversed(stack))
+
+    def hot_stacks(self, limit=20):
+        with self._lock:
+            total = self.sample_count
+            top = self.samples.most_common(limit)
+        return {'running': self.running,
+                'interval': self.interval,
+                'samples': total,
+                'stacks': [{'count': count,
+                            'share': count / total if total else 0,
+                            'stack': list(stack)} for stack, count in top]}
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+NumPy implementation of brother_ql.create_label().
+
+Image geometry (rotation, scaling, padding) is done exactly like brother_ql does it,
+but thresholding, red/black separation, mirroring and bit packing are done on the
+whole image at once instead of pixel by pixel / row by row in Python. The raster
+data written to qlr is byte-identical to the one of brother_ql.create_label().
+"""
+
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from brother_ql import BrotherQLUnsupportedCmd
+from brother_ql.devicedependent import label_type_specs, right_margin_addition
+from brother_ql.devicedependent import ENDLESS_LABEL, DIE_CUT_LABEL, ROUND_DIE_CUT_LABEL
+
+logger = logging.getLogger(__name__)
+
+def create_label(qlr, image, label_size, threshold=70, cut=True, dither=False, compress=False, red=False,
+                 rotate='auto', dpi_600=False, hq=True):
+    """ qlr has to provide add_raster_rows(), see implementation_brother.CompactRaster """
+    label_specs = label_type_specs[label_size]
+    right_margin_dots = label_specs['right_margin_dots'] + right_margin_addition.get(qlr.model, 0)
+    device_pixel_width = qlr.get_pixel_width()
+
+    if rotate != 'auto': rotate = int(rotate)
+    threshold = min(255, max(0, int((100.0 - threshold)/100.0 * 255)))
+
+    if red and not qlr.two_color_support:
+        raise BrotherQLUnsupportedCmd('Printing in red is not supported with the selected model.')
+
+    try:
+        qlr.add_switch_mode()
+    except BrotherQLUnsupportedCmd:
+        pass
+    qlr.add_invalidate()
+    qlr.add_initialize()
+    try:
+        qlr.add_switch_mode()
+    except BrotherQLUnsupportedCmd:
+        pass
+
+    im = prepare_image(image, label_specs, device_pixel_width, right_margin_dots, red, rotate, dpi_600)
+
+    if red:
+        black, red_mask = separate_red_black(im, threshold)
+    else:
+        black = to_mask(im, threshold, dither)
+
+    qlr.add_status_information()
+    tape_size = label_specs['tape_size']
+    if label_specs['kind'] in (DIE_CUT_LABEL, ROUND_DIE_CUT_LABEL):
+        qlr.mtype = 0x0B
+        qlr.mwidth = tape_size[0]
+        qlr.mlength = tape_size[1]
+    else:
+        qlr.mtype = 0x0A
+        qlr.mwidth = tape_size[0]
+        qlr.mlength = 0
+    qlr.pquality = int(hq)
+    qlr.add_media_and_quality(im.size[1])
+    try:
+        if cut:
+            qlr.add_autocut(True)
+            qlr.add_cut_every(1)
+    except BrotherQLUnsupportedCmd:
+        pass
+    try:
+        qlr.dpi_600 = dpi_600
+        qlr.cut_at_end = cut
+        qlr.two_color_printing = True if red else False
+        qlr.add_expanded_mode()
+    except BrotherQLUnsupportedCmd:
+        pass
+    qlr.add_margins(label_specs['feed_margin'])
+    try:
+        if compress: qlr.add_compression(True)
+    except BrotherQLUnsupportedCmd:
+        pass
+    if red:
+        qlr.add_raster_rows(pack_rows(black), pack_rows(red_mask))
+    else:
+        qlr.add_raster_rows(pack_rows(black))
+    qlr.add_print()
+
+    return qlr.data
+
+def prepare_image(im, label_specs, device_pixel_width, right_margin_dots, red, rotate, dpi_600):
+    """ Flatten, rotate, scale and pad the image to the printer's pixel width (same steps as brother_ql) """
+    dots_printable = label_specs['dots_printable']
+
+    if im.mode.endswith('A'):
+        # place in front of white background and get rid of transparency
+        bg = Image.new("RGB", im.size, (255,255,255))
+        bg.paste(im, im.split()[-1])
+        im = bg
+    elif im.mode == "P":
+        im = im.convert("RGB" if red else "L")
+    elif im.mode == "L" and red:
+        im = im.convert("RGB")
+
+    if dpi_600:
+        dots_expected = [el*2 for el in dots_printable]
+    else:
+        dots_expected = dots_printable
+
+    if label_specs['kind'] == ENDLESS_LABEL:
+        if rotate not in ('auto', 0):
+            im = im.rotate(rotate, expand=True)
+        if dpi_600:
+            im = im.resize((im.size[0]//2, im.size[1]))
+        if im.size[0] != dots_printable[0]:
+            hsize = int((dots_printable[0] / im.size[0]) * im.size[1])
+            im = im.resize((dots_printable[0], hsize), Image.LANCZOS)
+            logger.warning('Need to resize the image...')
+        if im.size[0] < device_pixel_width:
+            new_im = Image.new(im.mode, (device_pixel_width, im.size[1]), (255,)*len(im.mode))
+            new_im.paste(im, (device_pixel_width-im.size[0]-right_margin_dots, 0))
+            im = new_im
+    elif label_specs['kind'] in (DIE_CUT_LABEL, ROUND_DIE_CUT_LABEL):
+        if rotate == 'auto':
+            if im.size[0] == dots_expected[1] and im.size[1] == dots_expected[0]:
+                im = im.rotate(90, expand=True)
+        elif rotate != 0:
+            im = im.rotate(rotate, expand=True)
+        if im.size[0] != dots_expected[0] or im.size[1] != dots_expected[1]:
+            raise ValueError("Bad image dimensions: %s. Expecting: %s." % (im.size, dots_expected))
+        if dpi_600:
+            im = im.resize((im.size[0]//2, im.size[1]))
+        new_im = Image.new(im.mode, (device_pixel_width, dots_expected[1]), (255,)*len(im.mode))
+        new_im.paste(im, (device_pixel_width-im.size[0]-right_margin_dots, 0))
+        im = new_im
+    return im
+
+def to_mask(im, threshold, dither=False):
+    """ Boolean array, True where a dot has to be printed """
+    if dither:
+        return np.asarray(ImageOps.invert(im.convert("L")).convert("1", dither=Image.FLOYDSTEINBERG))
+    return (255 - np.asarray(im.convert("L"), dtype=np.int16)) >= threshold
+
+def separate_red_black(im, threshold):
+    """
+    Boolean arrays of the black and the red dots. Red are saturated, bright
+    reddish pixels, black are dark pixels which are not red.
+    """
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    hsv = np.asarray(im.convert("HSV"))
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    darkness = 255 - np.asarray(im.convert("L"), dtype=np.int16)
+
+    # pixels outside the selection become white, which is only printed with a threshold of 0
+    red_selected = ((h < 40) | (h > 210)) & (s > 100) & (v > 80)
+    red_mask = np.where(red_selected, darkness, 0) >= threshold
+    black = np.where(v < 80, darkness, 0) >= threshold
+    return black & ~red_mask, red_mask
+
+def pack_rows(mask):
+    """ Mirror the mask and pack it into one bytes object per raster line, MSB first """
+    # the printer's pixel width is a multiple of 8, so the lines can be packed in one go
+    data = np.packbits(mask[:, ::-1], axis=None).tobytes()
+    row_len = mask.shape[1]//8
+    return [data[start:start+row_len] for start in range(0, len(data), row_len)]
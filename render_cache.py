@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import hashlib, json, logging, mmap, os, tempfile, threading, time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# bump whenever rendering changes in a way that makes previously cached entries wrong
+CACHE_VERSION = 1
+
+def cache_key(*parts):
+    """ Stable content hash of the given JSON serializable parts """
+    data = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class NullCache:
+    """ Caching disabled """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+class MemoryCache:
+    """ In-process LRU cache holding at most max_bytes of values """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+
+class DirectoryCache:
+    """
+    Cache stored as one file per entry in a directory that can be shared by several
+    label_web instances (e.g. on NFS) and survives restarts.
+
+    File names are the content hash keys, entries are written to a temporary file
+    and atomically renamed into place, so readers never see partial entries. Reads
+    are memory-mapped. Once the directory grows beyond max_bytes, the least recently
+    used entries (by modification time, which is refreshed on every hit) are removed.
+
+    The size of the directory is tracked locally between writes, but since other
+    instances write to it as well, it is rescanned every rescan_interval seconds
+    or rescan_writes writes.
+    """
+
+    def __init__(self, folder, max_bytes=512 * 1024 * 1024, rescan_interval=60, rescan_writes=100):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self.rescan_writes = rescan_writes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._rescan()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh, \
+                 mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                value = mm[:]
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(value)
+            # same key, same content: replacing an entry does not grow the directory
+            replaced = os.path.exists(path)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning('Could not write cache entry %s: %s', key, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            if not replaced:
+                self._size += len(value)
+            self._writes += 1
+            if (self._size > self.max_bytes or self._writes >= self.rescan_writes
+                    or time.monotonic() - self._last_scan > self.rescan_interval):
+                self._rescan()
+
+    def _rescan(self):
+        self._size = self._evict()
+        self._writes = 0
+        self._last_scan = time.monotonic()
+
+    def _evict(self):
+        """ Remove the oldest entries until the cache is below 90% of max_bytes, returns the new size """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.tmp') and stat.st_mtime > time.time() - 3600:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return total
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        logger.debug('Evicted render cache entries, %d bytes left', total)
+        return total
+
+
+class LocalKeyValueStore:
+    """
+    In-process stand-in for a networked key-value store; implements the
+    get / set(key, value, ex=seconds) subset of the redis client API.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+
+class KeyValueCache:
+    """ Cache in a key-value store shared by all instances (anything with the redis get/set API) """
+
+    def __init__(self, client, ttl=24 * 3600, prefix='label_web:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning('Render cache lookup failed: %s', e)
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+        except Exception as e:
+            logger.warning('Render cache store failed: %s', e)
+
+
+def create_cache(config):
+    """
+    Create the render cache described by the CACHE section of the configuration:
+    BACKEND is one of "none", "memory", "directory" or "keyvalue".
+    """
+    backend = config.get('BACKEND', 'memory')
+    max_bytes = config.get('MAX_MB', 64) * 1024 * 1024
+    if backend == 'none':
+        return NullCache()
+    if backend == 'memory':
+        return MemoryCache(max_bytes)
+    if backend == 'directory':
+        return DirectoryCache(config.get('FOLDER', 'cache'), max_bytes)
+    if backend == 'keyvalue':
+        url = config.get('URL')
+        if url:
+            import redis
+            client = redis.Redis.from_url(url)
+        else:
+            client = LocalKeyValueStore()
+        return KeyValueCache(client, ttl=config.get('TTL', 24 * 3600))
+    raise ValueError('Unknown render cache backend: {}'.format(backend))